@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Quantize U²-Net to INT8 for Faster CPU Inference
+One-time step that converts the downloaded u2net.onnx model to INT8 using
+ONNX Runtime static quantization. The INT8 model halves weight traffic and
+uses int8 dot-product instructions on modern CPUs, typically 2-4x faster
+with negligible mask quality loss on product photos.
+
+remove_bg.py automatically uses the quantized model once it exists.
+"""
+
+from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+from PIL import Image
+import onnxruntime as ort
+import numpy as np
+import sys
+import os
+import glob
+
+U2NET_HOME = os.path.expanduser(os.getenv("U2NET_HOME", "~/.u2net"))
+MODEL_PATH = os.path.join(U2NET_HOME, "u2net.onnx")
+INT8_MODEL_PATH = os.path.join(U2NET_HOME, "u2net_int8.onnx")
+
+# Calibration images beyond this count add time but little accuracy
+MAX_CALIBRATION_IMAGES = 50
+
+def preprocess(image_path):
+    """Preprocess one image the same way rembg feeds U²-Net."""
+    img = Image.open(image_path).convert("RGB").resize((320, 320), Image.Resampling.LANCZOS)
+    arr = np.array(img).astype(np.float32)
+    arr = arr / max(arr.max(), 1e-6)
+    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+    arr = (arr - mean) / std
+    # HWC -> NCHW
+    return arr.transpose(2, 0, 1)[np.newaxis].astype(np.float32)
+
+class ProductImageReader(CalibrationDataReader):
+    """Feeds preprocessed product images to the quantization calibrator."""
+
+    def __init__(self, image_paths, input_name):
+        self.image_paths = iter(image_paths)
+        self.input_name = input_name
+
+    def get_next(self):
+        path = next(self.image_paths, None)
+        if path is None:
+            return None
+        return {self.input_name: preprocess(path)}
+
+def quantize(calibration_pattern):
+    """Quantize u2net.onnx to INT8 using the given calibration images."""
+    if not os.path.exists(MODEL_PATH):
+        print(f"✗ Model not found: {MODEL_PATH}")
+        print("  Run remove_bg.py once first so rembg downloads the model.")
+        sys.exit(1)
+
+    files = glob.glob(calibration_pattern)[:MAX_CALIBRATION_IMAGES]
+    if not files:
+        print(f"✗ No calibration images found matching: {calibration_pattern}")
+        sys.exit(1)
+
+    # Ask the model for its input name rather than hard-coding it
+    session = ort.InferenceSession(MODEL_PATH, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+
+    print(f"Calibrating with {len(files)} image(s)...")
+    reader = ProductImageReader(files, input_name)
+
+    quantize_static(
+        MODEL_PATH,
+        INT8_MODEL_PATH,
+        reader,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+    print(f"✓ Quantized model saved to: {INT8_MODEL_PATH}")
+    print("  remove_bg.py will use it automatically from now on.")
+
+def main():
+    """Main function to handle command line usage."""
+    if len(sys.argv) < 2:
+        print("Quantize U²-Net to INT8 for Faster CPU Inference")
+        print("=" * 50)
+        print("\nUsage:")
+        print("  python quantize_model.py <calibration_pattern>")
+        print("\nExamples:")
+        print("  python quantize_model.py raw/*.jpg")
+        print("  python quantize_model.py \"products/**/*.png\"")
+        print("\nUse ~50 representative product photos for calibration.")
+        sys.exit(1)
+
+    quantize(sys.argv[1])
+
+if __name__ == "__main__":
+    main()
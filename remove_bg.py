@@ -7,10 +7,171 @@ Supports batch processing of multiple images.
 
 from rembg import remove, new_session
 from PIL import Image
+from skip_cache import SkipCache
+import onnxruntime as ort
+import numpy as np
+import itertools
+import threading
+import queue
 import sys
 import os
 import glob
 
+# U²-Net input resolution and ImageNet normalization constants
+MODEL_INPUT_SIZE = (320, 320)
+MODEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+MODEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# Images fed to the model per inference call in batch mode
+BATCH_SIZE = 4
+
+def create_session():
+    """
+    Create a U²-Net session, dispatching to GPU/ANE when available.
+
+    Inference is the dominant cost, so prefer the CUDA (NVIDIA) and
+    CoreML (Apple Silicon) execution providers over plain CPU when the
+    installed onnxruntime supports them.
+    """
+    preferred = ["CUDAExecutionProvider", "CoreMLExecutionProvider",
+                 "CPUExecutionProvider"]
+    available = ort.get_available_providers()
+    providers = [p for p in preferred if p in available] or available
+
+    # rembg forwards OMP_NUM_THREADS to the session's intra-op thread pool
+    os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+
+    # Prefer the INT8 model produced by quantize_model.py (2-4x faster on CPU)
+    int8_model = _int8_model_path()
+    if os.path.exists(int8_model):
+        print("Using INT8 quantized model")
+        return new_session("u2net_custom", model_path=int8_model,
+                           providers=providers)
+
+    return new_session("u2net", providers=providers)
+
+def _int8_model_path():
+    """Path where quantize_model.py leaves the INT8 model."""
+    return os.path.join(
+        os.path.expanduser(os.getenv("U2NET_HOME", "~/.u2net")), "u2net_int8.onnx")
+
+class _BatchRunner:
+    """
+    Runs batched U²-Net inference through a reusable IOBinding.
+
+    The input tensor buffer is allocated once and bound to the session
+    up front, so onnxruntime reads inference input straight out of that
+    memory on every run instead of allocating and copying a fresh
+    tensor per batch. Rebinding only happens for the final partial
+    chunk, whose batch dimension differs.
+
+    batch_size is the largest chunk the model accepts: the stock
+    u2net.onnx is exported with a static batch dimension of 1, so only
+    models with a dynamic (symbolic) batch dimension get real batching;
+    static models fall back to per-image runs.
+    """
+
+    def __init__(self, session):
+        self._sess = session.inner_session
+        self._input_name = self._sess.get_inputs()[0].name
+        self._output_name = self._sess.get_outputs()[0].name
+        batch_dim = self._sess.get_inputs()[0].shape[0]
+        self.batch_size = batch_dim if isinstance(batch_dim, int) else BATCH_SIZE
+        self._buf = np.empty(
+            (self.batch_size, 3, MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0]),
+            np.float32)
+        self._io = None
+        self._bound = 0
+
+    def _bind(self, n):
+        self._io = self._sess.io_binding()
+        self._io.bind_cpu_input(self._input_name, self._buf[:n])
+        self._io.bind_output(self._output_name, 'cpu')
+        self._bound = n
+
+    def run(self, tensors):
+        """Run inference on a list of (3, 320, 320) tensors, returning masks."""
+        n = len(tensors)
+        for i, tensor in enumerate(tensors):
+            self._buf[i] = tensor
+        if n != self._bound:
+            self._bind(n)
+        self._sess.run_with_iobinding(self._io)
+        return self._io.copy_outputs_to_cpu()[0]
+
+def _output_path(input_path, output_dir=None):
+    """Build the output WebP path for an input image."""
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        return os.path.join(output_dir, f"{base_name}_no_bg.webp")
+    input_dir = os.path.dirname(input_path) or "."
+    return os.path.join(input_dir, f"{base_name}_no_bg.webp")
+
+def _load_image(input_path):
+    """
+    Fully decode an image plus a reduced copy for model input.
+
+    For JPEG sources the reduced copy comes from draft(), which scales
+    during decode in the DCT domain - essentially free - so the model
+    never pays for a full-resolution decode it immediately shrinks.
+
+    Returns (full_img, inference_img), or None on failure.
+    """
+    try:
+        # Cheap header-only validation keeps corrupt files out of the
+        # heavy decode and inference path
+        with Image.open(input_path) as probe:
+            probe.verify()
+
+        img = Image.open(input_path)
+        img.load()
+        small = img
+        if img.format == 'JPEG':
+            small = Image.open(input_path)
+            small.draft('RGB', (MODEL_INPUT_SIZE[0] * 2, MODEL_INPUT_SIZE[1] * 2))
+            small.load()
+        return img, small
+    except Exception as e:
+        print(f"✗ Error processing {input_path}: {e}")
+        return None
+
+def _preprocess(img):
+    """Convert an image to a normalized (3, 320, 320) float32 tensor,
+    mirroring rembg's U²-Net preprocessing."""
+    small = img.convert("RGB").resize(MODEL_INPUT_SIZE, Image.Resampling.LANCZOS,
+                                      reducing_gap=2.0)
+    arr = np.array(small).astype(np.float32)
+    arr = arr / max(arr.max(), 1e-6)
+    arr = (arr - MODEL_MEAN) / MODEL_STD
+    # HWC -> CHW
+    return arr.transpose(2, 0, 1)
+
+def _apply_mask(img, mask):
+    """Scale a raw model mask back to image size and apply it as alpha."""
+    mask = mask.squeeze()
+    mask = (mask - mask.min()) / max(mask.max() - mask.min(), 1e-6)
+    mask_img = Image.fromarray((mask * 255).astype(np.uint8), mode="L")
+    mask_img = mask_img.resize(img.size, Image.Resampling.LANCZOS)
+    cutout = img.convert("RGBA")
+    cutout.putalpha(mask_img)
+    return cutout
+
+def _save_cutout(input_path, img, mask, output_dir=None):
+    """Apply a predicted mask to a decoded image and save it as WebP."""
+    try:
+        output_img = _apply_mask(img, mask)
+        output_path = _output_path(input_path, output_dir)
+        output_img.save(output_path, 'WEBP', quality=95, method=4, lossless=False)
+
+        print(f"✓ Processed: {os.path.basename(input_path)} → {os.path.basename(output_path)}")
+
+        return output_path
+
+    except Exception as e:
+        print(f"✗ Error processing {input_path}: {e}")
+        return None
+
 def remove_background(input_path, output_dir=None, session=None):
     """
     Remove background from a product image using U²-Net and save as WebP.
@@ -21,23 +182,31 @@ def remove_background(input_path, output_dir=None, session=None):
         session: Reusable model session for batch processing
     """
     try:
+        # Cheap header-only validation before the model ever runs
+        with Image.open(input_path) as probe:
+            probe.verify()
+
         # Open input image
         input_img = Image.open(input_path)
-        
-        # Remove background
-        output_img = remove(input_img, session=session)
-        
-        # Determine output path
-        base_name = os.path.splitext(os.path.basename(input_path))[0]
-        if output_dir:
-            os.makedirs(output_dir, exist_ok=True)
-            output_path = os.path.join(output_dir, f"{base_name}_no_bg.webp")
+
+        # Remove background. For JPEG inputs, run the model on a cheap
+        # draft-scaled decode and upsample the mask back to full size -
+        # the model only sees 320x320 anyway, so quality is unchanged
+        if input_img.format == 'JPEG':
+            small = Image.open(input_path)
+            small.draft('RGB', (MODEL_INPUT_SIZE[0] * 2, MODEL_INPUT_SIZE[1] * 2))
+            mask = remove(small, session=session, only_mask=True)
+            mask = mask.resize(input_img.size, Image.Resampling.LANCZOS)
+            output_img = input_img.convert("RGBA")
+            output_img.putalpha(mask)
         else:
-            input_dir = os.path.dirname(input_path) or "."
-            output_path = os.path.join(input_dir, f"{base_name}_no_bg.webp")
-        
+            output_img = remove(input_img, session=session)
+
+        # Determine output path
+        output_path = _output_path(input_path, output_dir)
+
         # Save as WebP with transparency
-        output_img.save(output_path, 'WEBP', quality=95, lossless=False)
+        output_img.save(output_path, 'WEBP', quality=95, method=4, lossless=False)
         
         print(f"✓ Processed: {os.path.basename(input_path)} → {os.path.basename(output_path)}")
         
@@ -55,33 +224,128 @@ def process_batch(input_pattern, output_dir=None):
         input_pattern: File pattern (e.g., "products/*.jpg")
         output_dir: Directory for output images
     """
-    # Find matching files
-    files = glob.glob(input_pattern)
-    
-    if not files:
+    # Enumerate matching files lazily so huge directories stream into the
+    # batch loop instead of being stat()'d and held in memory up front
+    files_iter = glob.iglob(input_pattern, recursive=True)
+    first = next(files_iter, None)
+
+    if first is None:
         print(f"✗ No files found matching: {input_pattern}")
         sys.exit(1)
-    
-    print(f"Found {len(files)} image(s) to process")
-    print("Loading U²-Net model...")
-    
-    # Create session once for all images (faster for batch processing)
-    session = new_session("u2net")
-    
+
+    files_iter = itertools.chain([first], files_iter)
+
+    # The session is created lazily once the first non-skipped file shows
+    # up, so a fully cached re-run never pays the model load. Batch mode
+    # goes through the session's raw InferenceSession so several images
+    # share one run() call - same FLOPs, far fewer scheduler round-trips
+    # than calling rembg.remove() per image.
+    runner = None
+
     print("Processing images...\n")
-    
-    successful = 0
+
     failed = 0
-    
-    for file_path in files:
-        result = remove_background(file_path, output_dir, session)
-        if result:
-            successful += 1
-        else:
-            failed += 1
-    
+    results = []
+
+    # Skip inputs whose output is already up to date for this model
+    # (re-runs during parameter tuning are common)
+    model_tag = "u2net_int8" if os.path.exists(_int8_model_path()) else "u2net"
+    cache = SkipCache(output_dir, params=f"model={model_tag}")
+    skipped = [0]
+
+    # Three-stage pipeline: a reader thread decodes and preprocesses, the
+    # main thread runs batched inference, and a writer thread applies
+    # masks and encodes WebP. Bounded queues backpressure RAM while
+    # letting disk I/O on neighbouring images hide behind inference.
+    in_queue = queue.Queue(maxsize=BATCH_SIZE * 2)
+    out_queue = queue.Queue(maxsize=BATCH_SIZE * 2)
+
+    def _read_stage():
+        # The sentinel must go out even if this stage dies, or the main
+        # thread blocks on in_queue forever with no error shown
+        try:
+            for path in files_iter:
+                try:
+                    fresh = cache.fresh(path, _output_path(path, output_dir))
+                except OSError:
+                    # Unreadable input: let the load path report it below
+                    fresh = False
+                if fresh:
+                    skipped[0] += 1
+                    continue
+                in_queue.put((path, _load_image(path)))
+        finally:
+            in_queue.put(None)
+
+    def _write_stage():
+        while True:
+            item = out_queue.get()
+            if item is None:
+                break
+            path, img, mask = item
+            # One bad file must not kill the writer - a dead writer
+            # deadlocks the pipeline once out_queue fills up
+            try:
+                result = _save_cutout(path, img, mask, output_dir)
+                if result:
+                    cache.record(path, result)
+            except Exception as e:
+                print(f"✗ Error processing {path}: {e}")
+                result = None
+            results.append(result)
+
+    reader = threading.Thread(target=_read_stage, daemon=True)
+    writer = threading.Thread(target=_write_stage, daemon=True)
+    reader.start()
+    writer.start()
+
+    def _infer(pending):
+        nonlocal failed
+        try:
+            masks = runner.run([_preprocess(small) for _, (_, small) in pending])
+        except Exception as e:
+            for path, _ in pending:
+                print(f"✗ Error processing {path}: {e}")
+            failed += len(pending)
+            return
+        for (path, (img, _)), mask in zip(pending, masks):
+            out_queue.put((path, img, mask))
+
+    # Mirror the reader's guarantee: the writer must get its sentinel
+    # even if the inference loop dies, so it can drain and exit
+    pending = []
+    try:
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            path, pair = item
+            if pair is None:
+                failed += 1
+                continue
+            if runner is None:
+                print("Loading U²-Net model...")
+                runner = _BatchRunner(create_session())
+            pending.append((path, pair))
+            if len(pending) == runner.batch_size:
+                _infer(pending)
+                pending = []
+        if pending:
+            _infer(pending)
+    finally:
+        out_queue.put(None)
+        writer.join()
+
+    reader.join()
+    cache.save()
+
+    successful = sum(1 for result in results if result)
+    failed += sum(1 for result in results if not result)
+
     print(f"\n{'='*50}")
     print(f"Complete! Processed {successful} image(s)")
+    if skipped[0] > 0:
+        print(f"Skipped: {skipped[0]} image(s) (already up to date)")
     if failed > 0:
         print(f"Failed: {failed} image(s)")
 
@@ -116,7 +380,7 @@ def main():
             sys.exit(1)
         
         print("Loading U²-Net model...")
-        session = new_session("u2net")
+        session = create_session()
         print("Processing image...\n")
         
         result = remove_background(input_pattern, output_dir, session)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Skip Cache for Batch Re-runs
+Remembers a content+parameter hash for every output file so that
+re-running a batch (common while tuning parameters) skips inputs whose
+output is already up to date, instead of re-decoding and re-encoding
+everything. Stored as a sidecar .cache.json in the output directory.
+"""
+
+import hashlib
+import json
+import os
+
+CACHE_FILENAME = ".cache.json"
+
+def file_digest(path):
+    """Hash a file's contents with BLAKE2b (stdlib, SIMD-accelerated)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class SkipCache:
+    """
+    Content-hash cache mapping output paths to input+parameter keys.
+
+    A file may be skipped when its output already exists and the
+    recorded key matches, i.e. neither the input bytes nor the
+    processing parameters changed since the output was written.
+    """
+
+    def __init__(self, output_dir, params):
+        self._path = os.path.join(output_dir or ".", CACHE_FILENAME)
+        self._params = params
+        self._digests = {}
+        try:
+            with open(self._path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _key(self, input_path):
+        if input_path not in self._digests:
+            self._digests[input_path] = file_digest(input_path)
+        return f"{self._digests[input_path]}|{self._params}"
+
+    def fresh(self, input_path, output_path):
+        """True if output_path exists and is up to date for input_path."""
+        return (os.path.exists(output_path)
+                and self._entries.get(output_path) == self._key(input_path))
+
+    def record(self, input_path, output_path):
+        """Mark output_path as produced from input_path's current contents."""
+        self._entries[output_path] = self._key(input_path)
+
+    def save(self):
+        """Persist the cache; failures are non-fatal (cache is advisory)."""
+        try:
+            with open(self._path, 'w') as f:
+                json.dump(self._entries, f, indent=2)
+        except OSError:
+            pass